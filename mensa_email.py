@@ -19,13 +19,17 @@ Date: Oktober 2025
 """
 
 import io
+import functools
 import os
 import re
+import json
 import smtplib
 import logging
+import operator
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, List, Optional, Set, Tuple
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, Union
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
@@ -42,14 +46,41 @@ load_dotenv()
 WEEKDAYS_DE = ["Montag", "Dienstag", "Mittwoch", "Donnerstag", "Freitag", "Samstag", "Sonntag"]
 
 # Regex for parsing PDF content
-PRICE_LINE_RE = re.compile(r"(\d{1,2},\d{2})\s*€\s*\|\s*(\d{1,2},\d{2})\s*€\s*\|\s*(\d{1,2},\d{2})\s*€")
+# Whitespace that never crosses a line boundary (everything str.splitlines() splits on is excluded),
+# so a price line matches the same way whether searched per line or across a whole cell
+INLINE_SPACE = r"[^\S\n\r\x0b\x0c\x1c-\x1e\x85\u2028\u2029]*"
+PRICE_LINE_RE = re.compile(
+    r"(\d{1,2},\d{2}){s}€{s}\|{s}(\d{1,2},\d{2}){s}€{s}\|{s}(\d{1,2},\d{2}){s}€".replace("{s}", INLINE_SPACE)
+)
 ALLERGEN_TAIL_RE = re.compile(r"(.*?)\s*(\([0-9,\s\.a-z]+\))\s*$")
-ALLERGEN_MAP_RE = re.compile(r"(\d+[a-z]?)\s+([A-ZÄÖÜ][^\d\n]+?)(?=\s+\d+[a-z]?|\s*$)", re.MULTILINE)
+# Group 2 captures the allergen name without a trailing parenthetical note or colon
+ALLERGEN_MAP_RE = re.compile(r"(\d+[a-z]?)\s+([A-ZÄÖÜ][^\d\n]+?)(?:\s*\([^)]+\))?:?(?=\s+\d+[a-z]?|\s*$)", re.MULTILINE)
+# Parenthetical notes inside an allergen name, e.g. "Schalenfrüchte (Nüsse) und Erzeugnisse"
+ALLERGEN_NAME_PAREN_RE = re.compile(r"\s*\([^)]+\)")
+WHITESPACE_RE = re.compile(r"-\s+|\s+")
+
+# Shared HTTP session (keep-alive connection pooling, gzip/deflate by default)
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.headers.update({"User-Agent": "Mozilla/5.0 (compatible; MensaBot/1.0)"})
+
+# Static email HTML surrounding the per-day sections
+HTML_HEADER = (
+    '<html><head><style>body { font-family: sans-serif; } h2, h3 { color: #333; } p { margin: 0.5em 0; }</style></head><body>'
+    '<h1>HWR Mensa Menü</h1><hr>'
+)
+HTML_FOOTER = '<hr><p><small>Automatisch generiert vom HWR Mensa Bot.</small></p></body></html>'
 
 # PDF structure constants
 MENU_PAGE_INDEX = 1  # The menu is on the second page (index 1)
 # Column indices in the PDF table corresponding to Monday, Tuesday, etc.
 DISH_COLUMN_INDICES = [4, 8, 12, 16, 20]
+DAY_COLUMNS = list(zip(WEEKDAYS_DE[:5], DISH_COLUMN_INDICES))
+MIN_ROW_LENGTH = max(DISH_COLUMN_INDICES) + 1
+
+# Local cache for the downloaded PDF (revalidated via ETag/Last-Modified)
+CACHE_DIR = Path.home() / ".cache" / "mensa"
+CACHED_PDF_PATH = CACHE_DIR / "menu.pdf"
+CACHED_META_PATH = CACHE_DIR / "menu.meta.json"
 
 
 @dataclass
@@ -77,16 +108,16 @@ class Config:
         if not self.smtp_email or not self.smtp_password or not self.recipients:
             raise ValueError("Missing email config. Please set SMTP_EMAIL, SMTP_PASSWORD, and RECIPIENTS in .env")
 
-    @property
+    @functools.cached_property
     def filter_words(self) -> Set[str]:
         return {word.strip().lower() for word in self.filter_words_raw.split(",") if word.strip()}
 
-    @property
+    @functools.cached_property
     def filter_allergen_names(self) -> Set[str]:
         return {name.strip().lower() for name in self.filter_allergens_raw.split(",") if name.strip()}
 
 
-@dataclass
+@dataclass(slots=True)
 class Dish:
     """A structured representation of a single dish."""
     title: str
@@ -98,39 +129,127 @@ class Dish:
 class MensaParser:
     """Handles downloading and parsing the Mensa PDF."""
 
-    def __init__(self, pdf_content: bytes, config: Config):
-        self.pdf_content = pdf_content
+    def __init__(self, pdf_source: Union[bytes, Path], config: Config):
+        self.pdf_source = pdf_source
         self.config = config
-        self.allergen_map = self._extract_allergen_mapping()
+        self._filter_words_re = self._compile_filter_words(config.filter_words)
+        # Extract everything needed from the PDF up front so it is parsed and closed once
+        with self._open_pdf() as pdf:
+            last_page_text = pdf.pages[-1].extract_text()
+            self._raw_table = self._extract_menu_table(pdf)
+        self.allergen_map = self._extract_allergen_mapping(last_page_text)
         self.filter_allergen_numbers = self._resolve_filter_allergens()
+        self._has_word_filter = self._filter_words_re is not None
+        self._has_allergen_filter = bool(self.filter_allergen_numbers)
 
     @staticmethod
-    def download(url: str) -> bytes:
-        """Downloads the Mensa PDF from the server."""
+    def download(url: str) -> Union[bytes, Path]:
+        """Downloads the Mensa PDF from the server, reusing the cached copy if unchanged.
+
+        The response is streamed into the cache file and its path is returned. If the
+        cache directory is not writable, the PDF content is returned as bytes instead.
+        """
         logging.info("📥 Downloading latest menu...")
-        headers = {"User-Agent": "Mozilla/5.0 (compatible; MensaBot/1.0)"}
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
+        headers = {}
+        meta = MensaParser._load_cache_meta(url)
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        with HTTP_SESSION.get(url, headers=headers, timeout=15, stream=True) as response:
+            if response.status_code == 304 and meta:
+                logging.info("✅ Menu unchanged, using cached copy.")
+                return CACHED_PDF_PATH
+
+            response.raise_for_status()
+            pdf_source = MensaParser._stream_to_cache(url, response)
         logging.info("✅ Download complete.")
-        return response.content
+        return pdf_source
 
-    def _extract_allergen_mapping(self) -> Dict[str, str]:
-        """Extracts the allergen number-to-name mapping from the last PDF page."""
-        allergen_map = {}
-        with pdfplumber.open(io.BytesIO(self.pdf_content)) as pdf:
-            last_page_text = pdf.pages[-1].extract_text()
+    @staticmethod
+    def _load_cache_meta(url: str) -> Optional[Dict[str, str]]:
+        """Returns the cache validators for the given URL, if a cached PDF exists."""
+        try:
+            meta = json.loads(CACHED_META_PATH.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url or not CACHED_PDF_PATH.exists():
+            return None
+        return meta
 
-        for match in ALLERGEN_MAP_RE.finditer(last_page_text):
-            number, name = match.group(1), match.group(2).strip()
-            # Clean up the extracted name
-            name_clean = re.sub(r"\s*\([^)]+\)|:$", "", name).strip().lower()
-            if len(name_clean) < 3:
-                continue
+    @staticmethod
+    def _stream_to_cache(url: str, response: requests.Response) -> Union[bytes, Path]:
+        """Streams the PDF into the cache and stores its validators for conditional requests."""
+        # Write to a temporary file first so an aborted download never replaces the cache
+        partial_path = CACHED_PDF_PATH.with_name(CACHED_PDF_PATH.name + ".part")
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            partial_file = open(partial_path, "wb")
+        except OSError as e:
+            # Nothing has been read from the body yet, so fall back to keeping it in memory
+            logging.warning(f"⚠️ Could not cache menu PDF: {e}")
+            return response.content
+
+        try:
+            with partial_file:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    partial_file.write(chunk)
+            os.replace(partial_path, CACHED_PDF_PATH)
+        except Exception:
+            partial_path.unlink(missing_ok=True)
+            raise
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        try:
+            if etag or last_modified:
+                meta = {"url": url, "etag": etag, "last_modified": last_modified}
+                CACHED_META_PATH.write_text(json.dumps(meta), encoding="utf-8")
+            else:
+                CACHED_META_PATH.unlink(missing_ok=True)
+        except OSError as e:
+            logging.warning(f"⚠️ Could not store cache metadata: {e}")
+        return CACHED_PDF_PATH
 
-            allergen_map[name_clean] = number
-            first_word = name_clean.split()[0]
-            if first_word != name_clean:
-                allergen_map[first_word] = number
+    @staticmethod
+    def _compile_filter_words(words: Set[str]) -> Optional[re.Pattern]:
+        """Compiles the filter words into a single pattern matching any of them."""
+        if not words:
+            return None
+        return re.compile("|".join(re.escape(word) for word in sorted(words)))
+
+    def _open_pdf(self) -> "pdfplumber.PDF":
+        """Opens the downloaded PDF (cached file or in-memory bytes) with the PDF backend."""
+        if isinstance(self.pdf_source, bytes):
+            return pdfplumber.open(io.BytesIO(self.pdf_source))
+        return pdfplumber.open(self.pdf_source)
+
+    @staticmethod
+    def _extract_menu_table(pdf: "pdfplumber.PDF") -> Optional[List[List[str]]]:
+        """Extracts the raw menu table from the menu page of the PDF."""
+        if len(pdf.pages) <= MENU_PAGE_INDEX:
+            logging.error("PDF has fewer pages than expected. Cannot find menu.")
+            return None
+
+        table = pdf.pages[MENU_PAGE_INDEX].extract_table()
+        if not table:
+            logging.error("Could not extract table from PDF page.")
+            return None
+        return table
+
+    def _extract_allergen_mapping(self, last_page_text: str) -> Dict[str, str]:
+        """Extracts the allergen number-to-name mapping from the last PDF page's text."""
+        entries = [
+            ((ALLERGEN_NAME_PAREN_RE.sub("", name) if "(" in name else name).strip().lower(), number)
+            for number, name in ALLERGEN_MAP_RE.findall(last_page_text)
+        ]
+        full_names = {name: number for name, number in entries if len(name) >= 3}
+
+        # Also map the first word of multi-word names (e.g. 'milch'), without overriding full names
+        first_words = {name.split()[0]: number for name, number in full_names.items() if " " in name}
+        allergen_map = {**first_words, **full_names}
 
         if self.config.debug_mode:
             logging.debug(f"Found {len(allergen_map)} allergen mappings.")
@@ -152,15 +271,15 @@ class MensaParser:
         """Merges dish descriptions that span multiple rows in the PDF table."""
         merged_cells = {day: [] for day in WEEKDAYS_DE[:5]}
         for row in table:
-            if not row or len(row) < max(DISH_COLUMN_INDICES) + 1:
+            if not row or len(row) < MIN_ROW_LENGTH:
                 continue
 
-            for day, col_idx in zip(WEEKDAYS_DE[:5], DISH_COLUMN_INDICES):
+            for day, col_idx in DAY_COLUMNS:
                 cell_text = row[col_idx]
                 if not cell_text or not cell_text.strip():
                     continue
 
-                has_price = any(PRICE_LINE_RE.search(line) for line in cell_text.splitlines())
+                has_price = bool(PRICE_LINE_RE.search(cell_text))
                 # If the previous cell for this day had no price, merge this one into it
                 if merged_cells[day] and not merged_cells[day][-1]['has_price']:
                     merged_cells[day][-1]['text'] += '\n' + cell_text
@@ -176,19 +295,19 @@ class MensaParser:
             return None
 
         price_match, price_idx = None, -1
-        for i, line in reversed(list(enumerate(lines))):
-            match = PRICE_LINE_RE.search(line)
+        for i in range(len(lines) - 1, -1, -1):
+            match = PRICE_LINE_RE.search(lines[i])
             if match:
                 price_match, price_idx = match, i
                 break
 
         # Extract title and price
         title_lines = lines[:price_idx] if price_idx != -1 else lines
-        full_title = re.sub(r'-\s+|\s+', ' ', " ".join(title_lines)).strip()
+        full_title = WHITESPACE_RE.sub(' ', " ".join(title_lines)).strip()
         price = float(price_match.group(1).replace(",", ".")) if price_match else None
 
-        # Extract allergens from title
-        allergen_match = ALLERGEN_TAIL_RE.match(full_title)
+        # Extract allergens from title (the stripped title must end with the allergen list)
+        allergen_match = ALLERGEN_TAIL_RE.match(full_title) if full_title.endswith(")") else None
         if allergen_match:
             title = allergen_match.group(1).strip()
             allergens = {code.strip() for code in allergen_match.group(2).strip("()").split(",") if code.strip()}
@@ -198,9 +317,9 @@ class MensaParser:
         # Apply filters
         if price is None or len(title) < 5:
             return None
-        if self.config.filter_words and any(word in title.lower() for word in self.config.filter_words):
+        if self._has_word_filter and self._filter_words_re.search(title.lower()):
             return None
-        if self.filter_allergen_numbers and allergens.intersection(self.filter_allergen_numbers):
+        if self._has_allergen_filter and not allergens.isdisjoint(self.filter_allergen_numbers):
             return None
 
         return Dish(
@@ -214,22 +333,18 @@ class MensaParser:
         """Orchestrates the entire PDF parsing process."""
         logging.info("📄 Parsing PDF to extract dishes...")
         dishes_by_day = {day: [] for day in WEEKDAYS_DE}
-        with pdfplumber.open(io.BytesIO(self.pdf_content)) as pdf:
-            if len(pdf.pages) <= MENU_PAGE_INDEX:
-                logging.error("PDF has fewer pages than expected. Cannot find menu.")
-                return dishes_by_day
-
-            table = pdf.pages[MENU_PAGE_INDEX].extract_table()
-            if not table:
-                logging.error("Could not extract table from PDF page.")
-                return dishes_by_day
-
-            merged_cells = self._merge_table_cells(table)
-            for day, cells in merged_cells.items():
-                for cell in cells:
-                    dish = self._parse_dish_from_cell(cell['text'])
-                    if dish:
-                        dishes_by_day[day].append(dish)
+        if not self._raw_table:
+            return dishes_by_day
+
+        merged_cells = self._merge_table_cells(self._raw_table)
+        for day, cells in merged_cells.items():
+            for cell in cells:
+                # Cells without a price line can never yield a dish
+                if not cell['has_price']:
+                    continue
+                dish = self._parse_dish_from_cell(cell['text'])
+                if dish:
+                    dishes_by_day[day].append(dish)
 
         total_dishes = sum(len(d) for d in dishes_by_day.values())
         logging.info(f"✅ Found {total_dishes} dishes across all days.")
@@ -243,23 +358,18 @@ class EmailNotifier:
         self.config = config
 
     def _format_dish_section(self, dishes: List[Dish], title: str) -> str:
-        """Formats a list of dishes into an HTML section."""
+        """Formats a list of dishes (already sorted by price) into an HTML section."""
         if not dishes:
             return ""
 
-        # Sort dishes by price
-        sorted_dishes = sorted(dishes, key=lambda d: d.price)
-
-        html = f'<h3>{title}</h3>'
-        for dish in sorted_dishes:
-            html += f'<p><b>{dish.title}</b><br>{dish.price:.2f}€</p>'
-        return html
+        parts = [f'<h3>{title}</h3>']
+        parts.extend(f'<p><b>{dish.title}</b><br>{dish.price:.2f}€</p>' for dish in dishes)
+        return ''.join(parts)
 
     def _format_html_body(self, dishes_by_day: Dict[str, List[Dish]]) -> str:
         """Creates the full HTML email body."""
         today_idx = datetime.now().weekday()
-        html = '<html><head><style>body { font-family: sans-serif; } h2, h3 { color: #333; } p { margin: 0.5em 0; }</style></head><body>'
-        html += '<h1>HWR Mensa Menü</h1><hr>'
+        parts = [HTML_HEADER]
 
         days_to_show = []
         if today_idx < 5:  # Monday to Friday
@@ -268,23 +378,24 @@ class EmailNotifier:
             days_to_show.append(("Morgen", WEEKDAYS_DE[today_idx + 1]))
 
         if not days_to_show:
-            html += "<p>Schönes Wochenende! Keine Gerichte für heute oder morgen verfügbar.</p>"
+            parts.append("<p>Schönes Wochenende! Keine Gerichte für heute oder morgen verfügbar.</p>")
         else:
             for label, day_name in days_to_show:
                 day_dishes = dishes_by_day.get(day_name, [])
-                html += f'<h2>{label} ({day_name})</h2>'
+                parts.append(f'<h2>{label} ({day_name})</h2>')
                 if not day_dishes:
-                    html += '<p>Keine Gerichte verfügbar.</p>'
+                    parts.append('<p>Keine Gerichte verfügbar.</p>')
                 else:
-                    main_dishes = [d for d in day_dishes if d.category == 'main']
-                    side_dishes = [d for d in day_dishes if d.category == 'side']
-                    html += self._format_dish_section(main_dishes, "🥗 Hauptgerichte")
-                    html += self._format_dish_section(side_dishes, "🥔 Beilagen")
-                html += '<br>'
+                    # Sort once by price, then split into categories in a single pass
+                    main_dishes, side_dishes = [], []
+                    for dish in sorted(day_dishes, key=operator.attrgetter('price')):
+                        (main_dishes if dish.category == 'main' else side_dishes).append(dish)
+                    parts.append(self._format_dish_section(main_dishes, "🥗 Hauptgerichte"))
+                    parts.append(self._format_dish_section(side_dishes, "🥔 Beilagen"))
+                parts.append('<br>')
 
-        html += '<hr><p><small>Automatisch generiert vom HWR Mensa Bot.</small></p>'
-        html += '</body></html>'
-        return html
+        parts.append(HTML_FOOTER)
+        return ''.join(parts)
 
     def send(self, dishes_by_day: Dict[str, List[Dish]]):
         """Sends the formatted email to all configured recipients."""
@@ -293,13 +404,16 @@ class EmailNotifier:
         msg = MIMEMultipart("alternative")
         msg["Subject"] = f"Mensa HWR - {datetime.now().strftime('%d.%m')}"
         msg["From"] = self.config.smtp_email
-        msg["To"] = ", ".join(self.config.recipients)
-        msg.attach(MIMEText(html_content, "html"))
+        # Recipients go into Bcc so they don't see each other's addresses
+        msg["To"] = self.config.smtp_email
+        msg["Bcc"] = ", ".join(self.config.recipients)
+        msg.attach(MIMEText(html_content, "html", "utf-8"))
 
         logging.info(f"📧 Sending email to {len(self.config.recipients)} recipient(s)...")
         with smtplib.SMTP_SSL(self.config.smtp_host, self.config.smtp_port) as server:
             server.login(self.config.smtp_email, self.config.smtp_password)
-            server.sendmail(self.config.smtp_email, self.config.recipients, msg.as_string())
+            # send_message strips the Bcc header and delivers to all recipients in one session
+            server.send_message(msg, to_addrs=self.config.recipients)
         logging.info(f"✅ Email sent successfully to: {', '.join(self.config.recipients)}")
 
 
@@ -307,8 +421,8 @@ def main():
     """Main execution function."""
     try:
         config = Config()
-        pdf_content = MensaParser.download(config.pdf_url)
-        parser = MensaParser(pdf_content, config)
+        pdf_source = MensaParser.download(config.pdf_url)
+        parser = MensaParser(pdf_source, config)
         dishes = parser.get_all_dishes()
 
         notifier = EmailNotifier(config)